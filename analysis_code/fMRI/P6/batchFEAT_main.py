@@ -1,11 +1,14 @@
 # import time
+import argparse
+import multiprocessing as mp
 import os
 import sys
-import shutil
 import re
 import shlex
 import subprocess
 
+import nibabel as nib
+
 # import configparser
 
 import logging
@@ -15,100 +18,190 @@ logger.addHandler(logging.StreamHandler(stream=sys.stdout))
 logger.setLevel(logging.DEBUG)
 
 
-def run_command(scommand, capture_output=False):
-    logger.debug("About to run:\n{}".format(scommand))
-    sargs = shlex.split(scommand)
+def run_command(scommand, capture_output=False, cwd=None):
+    # scommand is an argv list; plain strings are deprecated and split with shlex
+    if isinstance(scommand, str):
+        sargs = shlex.split(scommand)
+    else:
+        sargs = list(scommand)
+    logger.debug("About to run:\n{}".format(shlex.join(sargs)))
     if capture_output:
-        process_results = subprocess.run(sargs, stdout=subprocess.PIPE)
+        process_results = subprocess.run(sargs, stdout=subprocess.PIPE, cwd=cwd)
     else:
-        process_results = subprocess.run(sargs)
+        process_results = subprocess.run(sargs, cwd=cwd)
     if process_results.returncode:
-        raise RuntimeError("Received non-zero return code: {}".format(process_results))
+        raise RuntimeError(
+            f"Command {sargs!r} failed with return code {process_results.returncode}"
+        )
     return process_results
 
 
-workingDir = os.getcwd()
-with open(os.path.join(workingDir, "directories.ini"), "r") as directories_file:
-    directories = directories_file.read()
-PD_dir = re.search('PD_dir="(.*)"', directories).group(1)
-# Injest directories.ini
-structuarlDir = os.path.abspath(PD_dir)
-template = os.path.join(workingDir, "design_template_main.fsf")
-toProcess = os.path.join(workingDir, "to_process_main.txt")
+def read_npts_tr(path):
+    """Read the volume count and TR from a 4D NIfTI header without loading voxel data."""
+    header = nib.load(path).header
+    return int(header.get_data_shape()[3]), float(header.get_zooms()[3])
+
+
 RAWFILEROOT = "BIYUJADEHE"
 STRUCTURALFILENAME = "final_structural"
 
-# Set path to structural ref
-with open(template, "r") as file:
-    fsfTemplate = file.read()
-fsfTemplate = re.sub(
-    r'(set highres_files\(1\) ").*"',
-    r"\1" + os.path.join(structuarlDir, STRUCTURALFILENAME) + '"',
-    fsfTemplate,
-)
-with open(template, "w") as file:
-    file.write(fsfTemplate)
-
-with open(toProcess, "r") as inputs:
-    for inputFilename in inputs:
-        # Grab the ID number of current input
-        cur_nifii = inputFilename[0:2]
-        logger.info("Starting block {}".format(cur_nifii))
-        block_dir = os.path.join(workingDir, "run" + cur_nifii)
-        os.makedirs(block_dir, exist_ok=True)
-
-        # Create block specific fsf file
-        block_design_path = os.path.join(block_dir, "block" + cur_nifii + "_design.fsf")
-        shutil.copy(template, block_design_path)
-        with open(block_design_path, "r") as file:
-            block_design = file.read()
-        # Update input file
-        input_file_root = os.path.join(workingDir, cur_nifii)
-        block_design = re.sub(
-            r'(set feat_files\(1\) ").*"', r"\1" + input_file_root + r'"', block_design
-        )
-        # Update output directory
-        block_design = re.sub(
-            r'(set fmri\(outputdir\) ").*"',
-            r"\1" + os.path.join(block_dir, cur_nifii + "-preprocess.feat") + r'"',
-            block_design,
-        )
-        # Update slice timings file
-        block_design = re.sub(
-            r'(set fmri\(st_file\) ").*"',
-            r"\1" + os.path.join(block_dir, "slicetimes.txt") + r'"',
-            block_design,
-        )
-        # Update volume count
-        cresult = run_command(
-            "sh getNumVolume.sh " + input_file_root + ".nii.gz", capture_output=True
-        )
-        num_volume = int(cresult.stdout)
-        block_design = re.sub(
-            r"(set fmri\(npts\) ).*", r"\g<1>" + str(num_volume), block_design
-        )
-        # Update TR duration
-        cresult = run_command(
-            "sh getTRDuration.sh " + input_file_root + ".nii.gz", capture_output=True
-        )
-        TR_duration = float(cresult.stdout)
-        block_design = re.sub(
-            r"(set fmri\(tr\) ).*", r"\g<1>{:.6f}".format(TR_duration), block_design
+# fsf template lines filled in by this script
+HIGHRES_RE = re.compile(r'(set highres_files\(1\) ").*"')
+FEAT_FILE_RE = re.compile(r'(set feat_files\(1\) ").*"')
+OUTDIR_RE = re.compile(r'(set fmri\(outputdir\) ").*"')
+ST_FILE_RE = re.compile(r'(set fmri\(st_file\) ").*"')
+NPTS_RE = re.compile(r"(set fmri\(npts\) ).*")
+TR_RE = re.compile(r"(set fmri\(tr\) ).*")
+# Image extensions FSL accepts, as tried by imtest
+IMAGE_EXTS = (".nii.gz", ".nii")
+# Run ID at the start of each line of to_process_main.txt
+RUN_ID_RE = re.compile(r"\s*(\d{2})")
+
+
+def make_placeholder_template(fsf, highres):
+    """Turn the per-run lines of a FEAT design file into str.format placeholders.
+
+    The structural reference is the same for every run, so it is set here once.
+    Any braces already in the design file are escaped, so only the placeholders below
+    are filled in by str.format: input_file_root, output_dir, st_file, npts and tr.
+    """
+    fsf = fsf.replace("{", "{{").replace("}", "}}")
+    highres = highres.replace("{", "{{").replace("}", "}}")
+    fsf = HIGHRES_RE.sub(lambda match: match.group(1) + highres + '"', fsf)
+    fsf = FEAT_FILE_RE.sub(r'\1{input_file_root}"', fsf)
+    fsf = OUTDIR_RE.sub(r'\1{output_dir}"', fsf)
+    fsf = ST_FILE_RE.sub(r'\1{st_file}"', fsf)
+    fsf = NPTS_RE.sub(r"\g<1>{npts}", fsf)
+    fsf = TR_RE.sub(r"\g<1>{tr:.6f}", fsf)
+    return fsf
+
+
+def process_run(inputFilename, workingDir, fsfTemplate):
+    """Set up and run the FEAT pre-processing of a single run from to_process_main.txt.
+
+    Returns False if the run was skipped because its image does not exist.
+    """
+    # Grab the ID number of current input
+    match = RUN_ID_RE.match(inputFilename)
+    if not match:
+        # Blank lines and # comments are expected; anything else is a malformed entry
+        if inputFilename.strip() and not inputFilename.lstrip().startswith("#"):
+            logger.warning(
+                "Ignoring %r in to_process_main.txt, it does not start with a run ID.",
+                inputFilename.strip(),
+            )
+        return
+    cur_nifii = match.group(1)
+    input_file_root = os.path.join(workingDir, cur_nifii)
+    # Either image extension will do, as for FSL's imtest
+    input_files = [
+        input_file_root + ext
+        for ext in IMAGE_EXTS
+        if os.path.exists(input_file_root + ext)
+    ]
+    if not input_files:
+        logger.warning(
+            "Skipping block %s, neither %s.nii.gz nor .nii exists.",
+            cur_nifii,
+            input_file_root,
         )
-        with open(block_design_path, "w") as file:
-            file.write(block_design)
-
-        # Create slice timings file
-        scommand = (
-            "sh makeSlicetimings.sh"
-            + (" ../../RawMRIData/TEMP2A_P6_TC/*" + RAWFILEROOT + ".00" + cur_nifii + ".0*.IMA")
-            + (" " + block_dir + "/slicetimes.txt")
-            + " {}".format(num_volume)
+        return False
+    logger.info("Starting block {}".format(cur_nifii))
+    block_dir = os.path.join(workingDir, "run" + cur_nifii)
+    os.makedirs(block_dir, exist_ok=True)
+
+    # Create block specific fsf file
+    num_volume, TR_duration = read_npts_tr(input_files[0])
+    block_design = fsfTemplate.format(
+        input_file_root=input_file_root,
+        output_dir=os.path.join(block_dir, cur_nifii + "-preprocess.feat"),
+        st_file=os.path.join(block_dir, "slicetimes.txt"),
+        npts=num_volume,
+        tr=TR_duration,
+    )
+    block_design_path = os.path.join(block_dir, "block" + cur_nifii + "_design.fsf")
+    with open(block_design_path, "wb") as file:
+        file.write(block_design.encode("utf-8"))
+
+    # Create slice timings file
+    scommand = [
+        "sh",
+        "makeSlicetimings.sh",
+        "../../RawMRIData/TEMP2A_P6_TC/*" + RAWFILEROOT + ".00" + cur_nifii + ".0*.IMA",
+        os.path.join(block_dir, "slicetimes.txt"),
+        str(num_volume),
+    ]
+    results = run_command(scommand)
+
+    # run FEAT
+    scommand = ["feat", block_design_path]
+    results = run_command(scommand, cwd=block_dir)
+
+
+# Arguments to process_run shared by every run, set once per pool worker
+_worker_state = {}
+
+
+def _init_worker(workingDir, fsfTemplate):
+    """Pool initializer storing the batch-wide process_run arguments in the worker."""
+    _worker_state["workingDir"] = workingDir
+    _worker_state["fsfTemplate"] = fsfTemplate
+
+
+def _process_run_in_worker(inputFilename):
+    """Run process_run in a pool worker, returning (line, status) instead of raising.
+
+    An exception escaping a worker makes the pool terminate the other workers, which
+    leaves their FEAT processes running unattended and the queued runs unstarted.
+    """
+    try:
+        ran = process_run(inputFilename, **_worker_state)
+    except Exception:
+        logger.exception("Run %r failed.", inputFilename.strip())
+        return inputFilename.strip(), "failed"
+    return inputFilename.strip(), "skipped" if ran is False else "done"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=max(1, mp.cpu_count() // 2),
+        help="Number of runs to pre-process in parallel (default: half the CPU count, "
+        "since FEAT does some threading of its own)",
+    )
+    args = parser.parse_args()
+
+    workingDir = os.getcwd()
+    with open(os.path.join(workingDir, "directories.ini"), "r") as directories_file:
+        directories = directories_file.read()
+    PD_dir = re.search('PD_dir="(.*)"', directories).group(1)
+    # Injest directories.ini
+    structuarlDir = os.path.abspath(PD_dir)
+    template = os.path.join(workingDir, "design_template_main.fsf")
+    toProcess = os.path.join(workingDir, "to_process_main.txt")
+
+    # Read the design template once; it is never written back to disk
+    with open(template, "r") as file:
+        fsfTemplate = make_placeholder_template(
+            file.read(), os.path.join(structuarlDir, STRUCTURALFILENAME)
         )
-        results = run_command(scommand)
 
-        # run FEAT
-        os.chdir(block_dir)
-        scommand = 'feat "' + block_design_path + '"'
-        results = run_command(scommand)
-        os.chdir(workingDir)
+    with open(toProcess, "r") as inputs:
+        inputFilenames = inputs.readlines()
+    # Hand the template to each worker once, rather than pickling it with every run
+    with mp.Pool(
+        processes=args.jobs, initializer=_init_worker, initargs=(workingDir, fsfTemplate)
+    ) as pool:
+        statuses = list(pool.imap_unordered(_process_run_in_worker, inputFilenames))
+        pool.close()
+        pool.join()
+    failed = [run for run, status in statuses if status == "failed"]
+    skipped = [run for run, status in statuses if status == "skipped"]
+    if failed or skipped:
+        msg = "{} runs failed: {}, and {} were skipped: {}".format(
+            len(failed), failed, len(skipped), skipped
+        )
+        logger.error(msg)
+        raise RuntimeError(msg)
@@ -6,11 +6,16 @@ Raises:
 """
 import argparse
 import logging
+import multiprocessing as mp
 import os
+import re
 import shlex
 import subprocess
 import sys
+from functools import lru_cache
+from string import Formatter
 
+import nibabel as nib
 from pandas import read_csv
 
 logger = logging.getLogger(__name__)
@@ -19,16 +24,47 @@ streamhdlr.setLevel(logging.INFO)
 logger.addHandler(streamhdlr)
 logger.setLevel(logging.DEBUG)
 
+# Two digit codes for the missing item EV files, one for each of the 25 image pairs.
+MISSING_CODES = (
+    "05", "06", "07", "08", "09",
+    "15", "16", "17", "18", "19",
+    "25", "26", "27", "28", "29",
+    "35", "36", "37", "38", "39",
+    "45", "46", "47", "48", "49",
+)
+CUE_EVS = ("testarraypostcue", "testarrayretrocue", "memoryarrayretrocue")
+# (template placeholder, EV file name) for each EV, after the EVfiles/GLM2_runNN_ prefix
+EV_FILES = tuple(
+    (f"missing{code}Path", f"missing{code}.txt") for code in MISSING_CODES
+) + tuple((cue + "Path", cue + ".txt") for cue in CUE_EVS)
+# Image extensions FSL accepts, e.g. denoised_data.nii with FSLOUTPUTTYPE=NIFTI
+IMAGE_EXTS = (".nii.gz", ".nii")
+# Run ID at the start of each line of to_process_main.txt
+RUN_ID_RE = re.compile(r"\s*(\d{2})")
+# Job script for --submit slurm; each array task runs one line of the run list
+SBATCH_TEMPLATE = """#!/bin/sh
+#SBATCH --job-name={job_name}
+#SBATCH --output={log_dir}/{job_name}_%A_%a.out
+RUN=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" "{run_list}")
+"{python}" "{script}" session --workingDir "{working_dir}" --single-run "$RUN"
+"""
+
 
-def run_command(scommand, capture_output=False):
+def run_command(scommand, capture_output=False, cwd=None, log_path=None):
     """Run a command with the shell.
 
     Arguments:
-        scommand {str} -- Command to be executed.
+        scommand {[str]} -- Command to be executed, as an argv list. A single string is
+            still accepted and split with shlex.split, but is deprecated.
 
     Keyword Arguments:
         capture_output {bool} -- Allow the output from the command to be accessed via the
             .stdout attribute on the returned CompletedProcess. (default: {False})
+        cwd {str} -- Directory to run the command in. Passed through to subprocess.run
+            so the process-wide working directory is never changed. (default: {None})
+        log_path {str} -- If given, stream stdout and stderr of the command to this file
+            instead of holding them in memory. Takes precedence over capture_output.
+            (default: {None})
 
     Raises:
         RuntimeError: Raised if the command returns a non-zero return code.
@@ -37,15 +73,24 @@ def run_command(scommand, capture_output=False):
         subprocess.CompletedProcess -- Result of subprocess.run.
 
     """
-    logger.info("About to run:\n{}".format(scommand))
-    sargs = shlex.split(scommand)
-    if capture_output:
-        process_results = subprocess.run(sargs, stdout=subprocess.PIPE)
+    if isinstance(scommand, str):
+        sargs = shlex.split(scommand)
     else:
-        process_results = subprocess.run(sargs)
+        sargs = list(scommand)
+    logger.info("About to run:\n{}".format(shlex.join(sargs)))
+    if log_path is not None:
+        with open(log_path, "wb") as log_file:
+            process_results = subprocess.run(
+                sargs, stdout=log_file, stderr=subprocess.STDOUT, cwd=cwd
+            )
+    elif capture_output:
+        process_results = subprocess.run(sargs, stdout=subprocess.PIPE, cwd=cwd)
+    else:
+        process_results = subprocess.run(sargs, cwd=cwd)
     if process_results.returncode:
-        logger.error("Received non-zero return code: {}".format(process_results))
-        raise RuntimeError("Received non-zero return code: {}".format(process_results))
+        msg = f"Command {sargs!r} failed with return code {process_results.returncode}"
+        logger.error(msg)
+        raise RuntimeError(msg)
     return process_results
 
 
@@ -73,142 +118,400 @@ def get_FileHandler(log_fname, debug_filelogging=True, overwrite=False):
     return logfile_handler
 
 
+def read_npts_tr(path):
+    """Read the volume count and TR from a 4D NIfTI header.
+
+    Only the header is parsed, no voxel data is loaded.
+
+    Arguments:
+        path {str} -- Path to a .nii or .nii.gz file.
+
+    Returns:
+        (int, float) -- Number of volumes (dim4) and TR duration (pixdim4).
+
+    """
+    header = nib.load(path).header
+    return int(header.get_data_shape()[3]), float(header.get_zooms()[3])
+
+
+def _compile_template(template):
+    """Split a str.format style fsf template into literal text and placeholders.
+
+    Done once per template, so filling it in for a run is a single join. As with
+    str.format, {{ and }} stand for literal braces.
+
+    Arguments:
+        template {str} -- Template string.
+
+    Raises:
+        ValueError: Raised for unbalanced braces, or for !r/!s/!a conversions, which
+            the fsf templates do not use.
+
+    Returns:
+        ((str, str, str)) -- (literal text, placeholder name or None, format spec)
+            for each piece of the template.
+
+    """
+    compiled = []
+    for literal, name, spec, conversion in Formatter().parse(template):
+        if conversion is not None:
+            raise ValueError(
+                "Unsupported conversion !{} in placeholder {}".format(conversion, name)
+            )
+        compiled.append((literal, name, spec))
+    return tuple(compiled)
+
+
+def image_paths(path):
+    """List the paths FSL would accept for an image, in the order imtest tries them.
+
+    Arguments:
+        path {str} -- Path to an image, with or without a .nii/.nii.gz extension.
+
+    Returns:
+        [str] -- path with each of IMAGE_EXTS.
+
+    """
+    for ext in IMAGE_EXTS:
+        if path.endswith(ext):
+            path = path[: -len(ext)]
+            break
+    return [path + ext for ext in IMAGE_EXTS]
+
+
+def find_missing_inputs(params):
+    """Find the input files referenced in params that do not exist.
+
+    Each directory is listed once and the file names are looked up in that listing,
+    rather than stat-ing every path separately. Like FSL's imtest, input_feat_file is
+    found with either image extension, and params is updated to the file that exists.
+
+    Arguments:
+        params {dict} -- Template parameters. input_feat_file and every key ending in
+            "Path" are checked.
+
+    Returns:
+        [str] -- Keys of params whose file is missing.
+
+    """
+    paths = {
+        k: v for k, v in params.items() if k == "input_feat_file" or k.endswith("Path")
+    }
+    listings = {}
+    for path in paths.values():
+        dirname = os.path.dirname(path)
+        if dirname not in listings:
+            try:
+                with os.scandir(dirname) as entries:
+                    listings[dirname] = {entry.name for entry in entries}
+            except FileNotFoundError:
+                listings[dirname] = set()
+    missing = []
+    for k, v in paths.items():
+        listing = listings[os.path.dirname(v)]
+        if k == "input_feat_file":
+            found = [
+                path for path in image_paths(v) if os.path.basename(path) in listing
+            ]
+            if found:
+                params[k] = found[0]
+                continue
+        elif os.path.basename(v) in listing:
+            continue
+        missing.append(k)
+    return missing
+
+
+@lru_cache(maxsize=4)
+def load_template(path):
+    """Read and compile an fsf template, caching the result by path.
+
+    Arguments:
+        path {str} -- Path to the fsf template.
+
+    Returns:
+        ((str, str, str)) -- Template compiled by _compile_template.
+
+    """
+    with open(path, "r") as file:
+        return _compile_template(file.read())
+
+
 def fill_in_template(template, params):
     """Fill in template placeholders according to params.
 
     Arguments:
-        template {str} -- Template string.
-        params {dict} -- Dict requires a key matching each template string placeholder
+        template {tuple} -- Template compiled by load_template.
+        params {dict} -- Dict requires a key matching each template placeholder
             variable name. Corresponding values will be inserted.
 
+    Raises:
+        KeyError: Raised, naming all of them, if any placeholder has no key in params.
+
     Returns:
         str -- Populated template string.
 
     """
-    return template.format(**params)
+    missing = {name for _, name, _ in template if name is not None} - params.keys()
+    if missing:
+        raise KeyError(
+            "No value for template placeholders: {}".format(", ".join(sorted(missing)))
+        )
+    return "".join(
+        literal if name is None else literal + format(params[name], spec)
+        for literal, name, spec in template
+    )
+
+
+def run_inputs(runDir, workingDir):
+    """Build the input file parameters of a run and check that the files exist.
+
+    Arguments:
+        runDir {str} -- Path to the run.
+        workingDir {str} -- Path to directory containing the EVfiles folder.
+
+    Returns:
+        dict -- input_feat_file and the EV paths, or None if the run folder or any of
+            its input files is missing. The reason is logged as a warning.
+
+    """
+    # Grab the ID number of current input
+    curRun = runDir[-2:]
+    if not os.path.isdir(runDir):
+        logger.warning("Skipping run %s, %s does not exist.", curRun, runDir)
+        return None
+
+    # Set parameters
+    params = {}
+    params["input_feat_file"] = os.path.join(runDir, curRun + "-preprocess.feat","denoised_data.nii.gz")
+    logger.debug("input_feat_file = %s", params["input_feat_file"])
+    # Set EV paths
+    EVPrefix = os.path.join(workingDir, "EVfiles", "GLM2_run" + curRun + "_")
+    params.update({key: EVPrefix + name for key, name in EV_FILES})
+    logger.debug("EV paths: %s", {k: v for k, v in params.items() if k.endswith("Path")})
+    missing = find_missing_inputs(params)
+    if missing:
+        logger.warning("Skipping run %s, missing input files: %s", curRun, missing)
+        return None
+    return params
+
+
+def process_run(runDir, workingDir, GLM2Template):
+    """Fill in the GLM template for a single run and run fsl's FEAT on it.
+
+    Arguments:
+        runDir {str} -- Path to the run to process.
+        workingDir {str} -- Path to directory containing the EVfiles folder.
+        GLM2Template {tuple} -- GLM2_template.fsf, compiled by load_template.
+
+    Returns:
+        bool -- True if FEAT was run, False if the run was skipped for missing inputs.
+
+    """
+    # Grab the ID number of current input
+    curRun = runDir[-2:]
+    params = run_inputs(runDir, workingDir)
+    if params is None:
+        return False
+    logger.info("Starting run {}".format(curRun))
+    # Get details on current block
+    #curRep = blockReps[blockReps["runNum"] == int(curRun)]
+
+    # Update volume count
+    params["numVolumes"], _ = read_npts_tr(params["input_feat_file"])
+    logger.debug("numVolumes = %s", params["numVolumes"])
+    # Update TR duration
+    #cresult = run_command(
+    #    "sh getTRDuration.sh " + params["input_feat_file"] + ".nii.gz",
+    #    capture_output=True,
+    #)
+    #params["TR_duration"] = float(cresult.stdout)
+    #logger.debug(f'TR_duration = {params["TR_duration"]}')
+
+    # Create block specific fsf file
+    blockGLMfsf = fill_in_template(GLM2Template, params)
+    blockGLMPath = os.path.join(runDir, "block" + curRun + "_GLM2.fsf")
+    with open(blockGLMPath, "wb") as file:
+        file.write(blockGLMfsf.encode("utf-8"))
+
+    # run FEAT
+    scommand = ["feat", blockGLMPath]
+    featLogPath = os.path.splitext(blockGLMPath)[0] + ".log"
+    results = run_command(scommand, cwd=runDir, log_path=featLogPath)
+    #logger.debug(f"feat CLI run results: {results}")
+    return True
+
+
+# Arguments to process_run shared by every run, set once per pool worker
+_worker_state = {}
+
+
+def _init_worker(workingDir, GLM2Template):
+    """Pool initializer storing the batch-wide process_run arguments in the worker."""
+    _worker_state["workingDir"] = workingDir
+    _worker_state["GLM2Template"] = GLM2Template
+
+
+def _process_run_in_worker(runDir):
+    """Run process_run in a pool worker, returning (runDir, status) instead of raising.
+
+    An exception escaping a worker makes the pool terminate the other workers, which
+    leaves their FEAT processes running unattended and the queued runs unstarted.
+    """
+    try:
+        ran = process_run(runDir, **_worker_state)
+    except Exception:
+        logger.exception("Run %s failed.", runDir[-2:])
+        return runDir, "failed"
+    return runDir, "done" if ran else "skipped"
 
 
-def session_GLM(workingDir, inputFolders):
+def session_GLM(workingDir, inputFolders, jobs=1):
     """Run initial session GLMs using fsl's FEAT.
 
     Arguments:
         workingDir {str} -- Path to directory containing template fsf files.
         inputFolders {[str]} -- List of paths to the runs to process.
+
+    Keyword Arguments:
+        jobs {int} -- Number of runs to process in parallel. (default: {1})
+
+    Raises:
+        RuntimeError: Raised once every run has been attempted, if any of them failed
+            or was skipped for missing inputs.
     """
     logger.addHandler(get_FileHandler(os.path.join(workingDir, "GLM2.log")))
-    with open(os.path.join(workingDir, "GLM2_template.fsf"), "r") as file:
-        GLM2Template = file.read()
-        logger.debug(f"Read GLM2Template from {file.name}.")
-
-    for runDir in inputFolders:
-        # Grab the ID number of current input
-        curRun = runDir[-2:]
-        logger.info("Starting run {}".format(curRun))
-        # Get details on current block
-        #curRep = blockReps[blockReps["runNum"] == int(curRun)]
-
-        # Set parameters
-        params = {}
-        params["input_feat_file"] = os.path.join(runDir, curRun + "-preprocess.feat","denoised_data.nii.gz")
-        logger.debug(f'input_feat_file = {params["input_feat_file"]}')
-        # Update volume count
-        cresult = run_command(
-            "sh getNumVolume.sh " + params["input_feat_file"],
-            capture_output=True,
+    templatePath = os.path.join(workingDir, "GLM2_template.fsf")
+    GLM2Template = load_template(templatePath)
+    logger.debug("Read GLM2Template from %s.", templatePath)
+
+    # Hand the template to each worker once, rather than pickling it with every run
+    with mp.Pool(
+        processes=jobs, initializer=_init_worker, initargs=(workingDir, GLM2Template)
+    ) as pool:
+        statuses = list(pool.imap_unordered(_process_run_in_worker, inputFolders))
+        pool.close()
+        pool.join()
+    failed = [runDir for runDir, status in statuses if status == "failed"]
+    skipped = [runDir for runDir, status in statuses if status == "skipped"]
+    if failed or skipped:
+        msg = "Of {} runs, {} failed: {}, and {} were skipped: {}".format(
+            len(statuses), len(failed), failed, len(skipped), skipped
         )
-        params["numVolumes"] = int(cresult.stdout)
-        logger.debug(f'numVolumes = {params["numVolumes"]}')
-        # Update TR duration
-        #cresult = run_command(
-        #    "sh getTRDuration.sh " + params["input_feat_file"] + ".nii.gz",
-        #    capture_output=True,
-        #)
-        #params["TR_duration"] = float(cresult.stdout)
-        #logger.debug(f'TR_duration = {params["TR_duration"]}')
-        # Set EV paths
-        EVPrefix = "EVfiles/GLM2_run" + curRun + "_"
-        params["missing05Path"] = os.path.join(workingDir, EVPrefix + "missing05.txt")
-        logger.debug(f'missing05Path = {params["missing05Path"]}')
-        params["missing06Path"] = os.path.join(workingDir, EVPrefix + "missing06.txt")
-        logger.debug(f'missing06Path = {params["missing06Path"]}')
-        params["missing07Path"] = os.path.join(workingDir, EVPrefix + "missing07.txt")
-        logger.debug(f'missing07Path = {params["missing07Path"]}')
-        params["missing08Path"] = os.path.join(workingDir, EVPrefix + "missing08.txt")
-        logger.debug(f'missing08Path = {params["missing08Path"]}')
-        params["missing09Path"] = os.path.join(workingDir, EVPrefix + "missing09.txt")
-        logger.debug(f'missing09Path = {params["missing09Path"]}')
-        params["missing15Path"] = os.path.join(workingDir, EVPrefix + "missing15.txt")
-        logger.debug(f'missing15Path = {params["missing15Path"]}')
-        params["missing16Path"] = os.path.join(workingDir, EVPrefix + "missing16.txt")
-        logger.debug(f'missing16Path = {params["missing16Path"]}')
-        params["missing17Path"] = os.path.join(workingDir, EVPrefix + "missing17.txt")
-        logger.debug(f'missing17Path = {params["missing17Path"]}')
-        params["missing18Path"] = os.path.join(workingDir, EVPrefix + "missing18.txt")
-        logger.debug(f'missing18Path = {params["missing18Path"]}')
-        params["missing19Path"] = os.path.join(workingDir, EVPrefix + "missing19.txt")
-        logger.debug(f'missing19Path = {params["missing19Path"]}')
-        params["missing25Path"] = os.path.join(workingDir, EVPrefix + "missing25.txt")
-        logger.debug(f'missing25Path = {params["missing25Path"]}')
-        params["missing26Path"] = os.path.join(workingDir, EVPrefix + "missing26.txt")
-        logger.debug(f'missing26Path = {params["missing26Path"]}')
-        params["missing27Path"] = os.path.join(workingDir, EVPrefix + "missing27.txt")
-        logger.debug(f'missing27Path = {params["missing27Path"]}')
-        params["missing28Path"] = os.path.join(workingDir, EVPrefix + "missing28.txt")
-        logger.debug(f'missing28Path = {params["missing28Path"]}')
-        params["missing29Path"] = os.path.join(workingDir, EVPrefix + "missing29.txt")
-        logger.debug(f'missing29Path = {params["missing29Path"]}')
-        params["missing35Path"] = os.path.join(workingDir, EVPrefix + "missing35.txt")
-        logger.debug(f'missing35Path = {params["missing35Path"]}')
-        params["missing36Path"] = os.path.join(workingDir, EVPrefix + "missing36.txt")
-        logger.debug(f'missing36Path = {params["missing36Path"]}')
-        params["missing37Path"] = os.path.join(workingDir, EVPrefix + "missing37.txt")
-        logger.debug(f'missing37Path = {params["missing37Path"]}')
-        params["missing38Path"] = os.path.join(workingDir, EVPrefix + "missing38.txt")
-        logger.debug(f'missing38Path = {params["missing38Path"]}')
-        params["missing39Path"] = os.path.join(workingDir, EVPrefix + "missing39.txt")
-        logger.debug(f'missing39Path = {params["missing39Path"]}')
-        params["missing45Path"] = os.path.join(workingDir, EVPrefix + "missing45.txt")
-        logger.debug(f'missing45Path = {params["missing45Path"]}')
-        params["missing46Path"] = os.path.join(workingDir, EVPrefix + "missing46.txt")
-        logger.debug(f'missing46Path = {params["missing46Path"]}')
-        params["missing47Path"] = os.path.join(workingDir, EVPrefix + "missing47.txt")
-        logger.debug(f'missing47Path = {params["missing47Path"]}')
-        params["missing48Path"] = os.path.join(workingDir, EVPrefix + "missing48.txt")
-        logger.debug(f'missing48Path = {params["missing48Path"]}')
-        params["missing49Path"] = os.path.join(workingDir, EVPrefix + "missing49.txt")
-        logger.debug(f'missing49Path = {params["missing49Path"]}')
-        params["testarraypostcuePath"] = os.path.join(workingDir, EVPrefix + "testarraypostcue.txt")
-        logger.debug(f'testarraypostcuePath = {params["testarraypostcuePath"]}')
-        params["testarrayretrocuePath"] = os.path.join(workingDir, EVPrefix + "testarrayretrocue.txt")
-        logger.debug(f'testarrayretrocuePath = {params["testarrayretrocuePath"]}')
-        params["memoryarrayretrocuePath"] = os.path.join(workingDir, EVPrefix + "memoryarrayretrocue.txt")
-        logger.debug(f'memoryarrayretrocuePath = {params["memoryarrayretrocuePath"]}')
-
-        # Create block specific fsf file
-        blockGLMfsf = fill_in_template(GLM2Template, params)
-        blockGLMPath = os.path.join(runDir, "block" + curRun + "_GLM2.fsf")
-        with open(blockGLMPath, "w") as file:
-            file.write(blockGLMfsf)
-
-        # run FEAT
-        curDir = os.getcwd()
-        os.chdir(runDir)
-        scommand = 'feat "' + blockGLMPath + '"'
-        results = run_command(scommand,capture_output=True)
-        #logger.debug(f"feat CLI run results: {results}")
-        os.chdir(curDir)
+        logger.error(msg)
+        raise RuntimeError(msg)
+
+
+def submit_slurm(workingDir, inputFolders):
+    """Submit the runs as a SLURM array job, one array task per run.
+
+    Runs with missing inputs are left out, rather than spending array tasks on runs
+    that would be skipped straight away. Writes the run IDs and the job script next
+    to the template fsf files, then calls sbatch. Each array task re-runs this script
+    with --single-run.
+
+    Arguments:
+        workingDir {str} -- Path to directory containing template fsf files.
+        inputFolders {[str]} -- List of paths to the runs to process.
+
+    Raises:
+        RuntimeError: Raised after submitting the other runs, if any run was left out
+            for missing inputs.
+
+    Returns:
+        subprocess.CompletedProcess -- Result of the sbatch call, or None if there
+            were no runs to submit.
+
+    """
+    skipped = [
+        runDir for runDir in inputFolders if run_inputs(runDir, workingDir) is None
+    ]
+    inputFolders = [runDir for runDir in inputFolders if runDir not in skipped]
+    results = None
+    if not inputFolders:
+        logger.warning("No runs to submit.")
+    else:
+        jobName = os.path.splitext(os.path.basename(__file__))[0]
+        runList = os.path.join(workingDir, jobName + "_runlist.txt")
+        with open(runList, "w") as file:
+            file.writelines(runDir[-2:] + "\n" for runDir in inputFolders)
+        sbatchPath = os.path.join(workingDir, jobName + "_sbatch.sh")
+        with open(sbatchPath, "w") as file:
+            file.write(
+                SBATCH_TEMPLATE.format(
+                    job_name=jobName,
+                    log_dir=workingDir,
+                    run_list=runList,
+                    python=sys.executable,
+                    script=os.path.abspath(__file__),
+                    working_dir=workingDir,
+                )
+            )
+        results = run_command(
+            ["sbatch", "--array=0-{}".format(len(inputFolders) - 1), sbatchPath],
+            cwd=workingDir,
+        )
+    if skipped:
+        msg = "{} runs were not submitted for missing inputs: {}".format(
+            len(skipped), skipped
+        )
+        logger.error(msg)
+        raise RuntimeError(msg)
+    return results
+
+
+def read_run_ids(toProcess):
+    """Read the run IDs listed in to_process_main.txt.
+
+    Arguments:
+        toProcess {str} -- Path to to_process_main.txt.
+
+    Returns:
+        [str] -- The two digit ID at the start of each line. Blank lines and # comments
+            are skipped; any other line without a run ID is skipped with a warning, so
+            a malformed file does not quietly shrink the batch.
+
+    """
+    runIDs = []
+    with open(toProcess, "r") as inputs:
+        for line in inputs:
+            match = RUN_ID_RE.match(line)
+            if match:
+                runIDs.append(match.group(1))
+            elif line.strip() and not line.lstrip().startswith("#"):
+                logger.warning(
+                    "Ignoring %r in %s, it does not start with a run ID.",
+                    line.strip(),
+                    toProcess,
+                )
+    return runIDs
+
+
+def run_id(value):
+    """argparse type for --single-run, a two digit run ID such as 01."""
+    match = RUN_ID_RE.fullmatch(value)
+    if not match:
+        raise argparse.ArgumentTypeError(
+            "expected a two digit run ID such as 01, got {!r}".format(value)
+        )
+    return match.group(1)
+
 
 def session_GLM_CLI(args):
     workingDir = os.path.abspath(os.path.expanduser(args.workingDir))
+    if args.single_run is not None:
+        # One task of a --submit slurm array job
+        session_GLM(workingDir, [os.path.join(workingDir, "run" + args.single_run)])
+        return
     # Use to_process.txt to define input run folders
     toProcess = os.path.join(workingDir, "to_process_main.txt")
-    inputFolders = []
-    with open(toProcess, "r") as inputs:
-        for inputFilename in inputs:
-            # Grab the ID number of current input
-            cur_nifii = inputFilename[0:2]
-            inputFolders += [os.path.join(workingDir, "run" + cur_nifii)]
-    session_GLM(workingDir, inputFolders)
+    inputFolders = [
+        os.path.join(workingDir, "run" + runID) for runID in read_run_ids(toProcess)
+    ]
+    if args.submit == "slurm":
+        submit_slurm(workingDir, inputFolders)
+    else:
+        session_GLM(workingDir, inputFolders, jobs=args.jobs)
 
 
 if __name__ == "__main__":
@@ -222,7 +525,26 @@ if __name__ == "__main__":
         default=".",
         help="Working directory containing template fsf files",
     )
+    sessionParser.add_argument(
+        "--jobs",
+        type=int,
+        default=max(1, mp.cpu_count() // 2),
+        help="Number of runs to process in parallel (default: half the CPU count, "
+        "since FEAT does some threading of its own)",
+    )
+    sessionParser.add_argument(
+        "--submit",
+        choices=("local", "slurm"),
+        default="local",
+        help="Run FEAT here (local, default) or submit one SLURM array task per run",
+    )
+    sessionParser.add_argument(
+        "--single-run",
+        metavar="RUN",
+        type=run_id,
+        help="Process only the run with this ID, e.g. 01, ignoring to_process_main.txt",
+    )
 
     args = parser.parse_args()
-    logger.debug(f"Parsed: {args}")
+    logger.debug("Parsed: %s", args)
     args.func(args)
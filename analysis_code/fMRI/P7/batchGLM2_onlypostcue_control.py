@@ -6,11 +6,16 @@ Raises:
 """
 import argparse
 import logging
+import multiprocessing as mp
 import os
+import re
 import shlex
 import subprocess
 import sys
+from functools import lru_cache
+from string import Formatter
 
+import nibabel as nib
 from pandas import read_csv
 
 logger = logging.getLogger(__name__)
@@ -19,16 +24,51 @@ streamhdlr.setLevel(logging.INFO)
 logger.addHandler(streamhdlr)
 logger.setLevel(logging.DEBUG)
 
+# Two digit codes for the missing item EV files, one for each of the 25 image pairs.
+MISSING_CODES = (
+    "05", "06", "07", "08", "09",
+    "15", "16", "17", "18", "19",
+    "25", "26", "27", "28", "29",
+    "35", "36", "37", "38", "39",
+    "45", "46", "47", "48", "49",
+)
+# (EV file name suffix, template placeholder suffix) for correct and incorrect trials
+KINDS = (("onlypostcorr", "CorrPath"), ("onlypostincorr", "IncorrPath"))
+CUE_EVS = ("testarraypostcue", "testarrayretrocue", "memoryarrayretrocue")
+# (template placeholder, EV file name) for each EV, after the EVfiles/GLM2_runNN_ prefix
+EV_FILES = tuple(
+    (f"missing{code}{suffix}", f"missing{code}_{kind}.txt")
+    for code in MISSING_CODES
+    for kind, suffix in KINDS
+) + tuple((cue + "Path", cue + ".txt") for cue in CUE_EVS)
+# Image extensions FSL accepts, e.g. denoised_data.nii with FSLOUTPUTTYPE=NIFTI
+IMAGE_EXTS = (".nii.gz", ".nii")
+# Run ID at the start of each line of to_process_main.txt
+RUN_ID_RE = re.compile(r"\s*(\d{2})")
+# Job script for --submit slurm; each array task runs FEAT on one line of the fsf list
+SBATCH_TEMPLATE = """#!/bin/sh
+#SBATCH --job-name={job_name}
+#SBATCH --output={log_dir}/{job_name}_%A_%a.out
+FSF=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" "{fsf_list}")
+cd "$(dirname "$FSF")" && feat "$FSF" > "${{FSF%.fsf}}.log" 2>&1
+"""
+
 
-def run_command(scommand, capture_output=False):
+def run_command(scommand, capture_output=False, cwd=None, log_path=None):
     """Run a command with the shell.
 
     Arguments:
-        scommand {str} -- Command to be executed.
+        scommand {[str]} -- Command to be executed, as an argv list. A single string is
+            still accepted and split with shlex.split, but is deprecated.
 
     Keyword Arguments:
         capture_output {bool} -- Allow the output from the command to be accessed via the
             .stdout attribute on the returned CompletedProcess. (default: {False})
+        cwd {str} -- Directory to run the command in. Passed through to subprocess.run
+            so the process-wide working directory is never changed. (default: {None})
+        log_path {str} -- If given, stream stdout and stderr of the command to this file
+            instead of holding them in memory. Takes precedence over capture_output.
+            (default: {None})
 
     Raises:
         RuntimeError: Raised if the command returns a non-zero return code.
@@ -37,15 +77,24 @@ def run_command(scommand, capture_output=False):
         subprocess.CompletedProcess -- Result of subprocess.run.
 
     """
-    logger.info("About to run:\n{}".format(scommand))
-    sargs = shlex.split(scommand)
-    if capture_output:
-        process_results = subprocess.run(sargs, stdout=subprocess.PIPE)
+    if isinstance(scommand, str):
+        sargs = shlex.split(scommand)
     else:
-        process_results = subprocess.run(sargs)
+        sargs = list(scommand)
+    logger.info("About to run:\n{}".format(shlex.join(sargs)))
+    if log_path is not None:
+        with open(log_path, "wb") as log_file:
+            process_results = subprocess.run(
+                sargs, stdout=log_file, stderr=subprocess.STDOUT, cwd=cwd
+            )
+    elif capture_output:
+        process_results = subprocess.run(sargs, stdout=subprocess.PIPE, cwd=cwd)
+    else:
+        process_results = subprocess.run(sargs, cwd=cwd)
     if process_results.returncode:
-        logger.error("Received non-zero return code: {}".format(process_results))
-        raise RuntimeError("Received non-zero return code: {}".format(process_results))
+        msg = f"Command {sargs!r} failed with return code {process_results.returncode}"
+        logger.error(msg)
+        raise RuntimeError(msg)
     return process_results
 
 
@@ -73,192 +122,364 @@ def get_FileHandler(log_fname, debug_filelogging=True, overwrite=False):
     return logfile_handler
 
 
+def read_npts_tr(path):
+    """Read the volume count and TR from a 4D NIfTI header.
+
+    Only the header is parsed, no voxel data is loaded.
+
+    Arguments:
+        path {str} -- Path to a .nii or .nii.gz file.
+
+    Returns:
+        (int, float) -- Number of volumes (dim4) and TR duration (pixdim4).
+
+    """
+    header = nib.load(path).header
+    return int(header.get_data_shape()[3]), float(header.get_zooms()[3])
+
+
+def _compile_template(template):
+    """Split a str.format style fsf template into literal text and placeholders.
+
+    Done once per template, so filling it in for a run is a single join. As with
+    str.format, {{ and }} stand for literal braces.
+
+    Arguments:
+        template {str} -- Template string.
+
+    Raises:
+        ValueError: Raised for unbalanced braces, or for !r/!s/!a conversions, which
+            the fsf templates do not use.
+
+    Returns:
+        ((str, str, str)) -- (literal text, placeholder name or None, format spec)
+            for each piece of the template.
+
+    """
+    compiled = []
+    for literal, name, spec, conversion in Formatter().parse(template):
+        if conversion is not None:
+            raise ValueError(
+                "Unsupported conversion !{} in placeholder {}".format(conversion, name)
+            )
+        compiled.append((literal, name, spec))
+    return tuple(compiled)
+
+
+def image_paths(path):
+    """List the paths FSL would accept for an image, in the order imtest tries them.
+
+    Arguments:
+        path {str} -- Path to an image, with or without a .nii/.nii.gz extension.
+
+    Returns:
+        [str] -- path with each of IMAGE_EXTS.
+
+    """
+    for ext in IMAGE_EXTS:
+        if path.endswith(ext):
+            path = path[: -len(ext)]
+            break
+    return [path + ext for ext in IMAGE_EXTS]
+
+
+def find_missing_inputs(params):
+    """Find the input files referenced in params that do not exist.
+
+    Each directory is listed once and the file names are looked up in that listing,
+    rather than stat-ing every path separately. Like FSL's imtest, input_feat_file is
+    found with either image extension, and params is updated to the file that exists.
+
+    Arguments:
+        params {dict} -- Template parameters. input_feat_file and every key ending in
+            "Path" are checked.
+
+    Returns:
+        [str] -- Keys of params whose file is missing.
+
+    """
+    paths = {
+        k: v for k, v in params.items() if k == "input_feat_file" or k.endswith("Path")
+    }
+    listings = {}
+    for path in paths.values():
+        dirname = os.path.dirname(path)
+        if dirname not in listings:
+            try:
+                with os.scandir(dirname) as entries:
+                    listings[dirname] = {entry.name for entry in entries}
+            except FileNotFoundError:
+                listings[dirname] = set()
+    missing = []
+    for k, v in paths.items():
+        listing = listings[os.path.dirname(v)]
+        if k == "input_feat_file":
+            found = [
+                path for path in image_paths(v) if os.path.basename(path) in listing
+            ]
+            if found:
+                params[k] = found[0]
+                continue
+        elif os.path.basename(v) in listing:
+            continue
+        missing.append(k)
+    return missing
+
+
+@lru_cache(maxsize=4)
+def load_template(path):
+    """Read and compile an fsf template, caching the result by path.
+
+    Arguments:
+        path {str} -- Path to the fsf template.
+
+    Returns:
+        ((str, str, str)) -- Template compiled by _compile_template.
+
+    """
+    with open(path, "r") as file:
+        return _compile_template(file.read())
+
+
 def fill_in_template(template, params):
     """Fill in template placeholders according to params.
 
     Arguments:
-        template {str} -- Template string.
-        params {dict} -- Dict requires a key matching each template string placeholder
+        template {tuple} -- Template compiled by load_template.
+        params {dict} -- Dict requires a key matching each template placeholder
             variable name. Corresponding values will be inserted.
 
+    Raises:
+        KeyError: Raised, naming all of them, if any placeholder has no key in params.
+
     Returns:
         str -- Populated template string.
 
     """
-    return template.format(**params)
+    missing = {name for _, name, _ in template if name is not None} - params.keys()
+    if missing:
+        raise KeyError(
+            "No value for template placeholders: {}".format(", ".join(sorted(missing)))
+        )
+    return "".join(
+        literal if name is None else literal + format(params[name], spec)
+        for literal, name, spec in template
+    )
+
 
+def write_run_fsf(runDir, workingDir, GLM2Template):
+    """Fill in the GLM template for a single run and write the run's fsf file.
 
-def session_GLM(workingDir, inputFolders):
+    Arguments:
+        runDir {str} -- Path to the run to process.
+        workingDir {str} -- Path to directory containing the EVfiles folder.
+        GLM2Template {tuple} -- GLM2_template_onlypostcue_control.fsf, compiled by
+            load_template.
+
+    Returns:
+        str -- Path to the written fsf file, or None if the run was skipped.
+
+    """
+    # Grab the ID number of current input
+    curRun = runDir[-2:]
+    if not os.path.isdir(runDir):
+        logger.warning("Skipping run %s, %s does not exist.", curRun, runDir)
+        return None
+    logger.info("Starting run {}".format(curRun))
+    # Get details on current block
+    #curRep = blockReps[blockReps["runNum"] == int(curRun)]
+
+    # Set parameters
+    params = {}
+    params["input_feat_file"] = os.path.join(runDir, curRun + "-preprocess.feat","denoised_data.nii.gz")
+    logger.debug("input_feat_file = %s", params["input_feat_file"])
+    # Set EV paths
+    EVPrefix = os.path.join(workingDir, "EVfiles", "GLM2_run" + curRun + "_")
+    params.update({key: EVPrefix + name for key, name in EV_FILES})
+    logger.debug("EV paths: %s", {k: v for k, v in params.items() if k.endswith("Path")})
+    missing = find_missing_inputs(params)
+    if missing:
+        logger.warning("Skipping run %s, missing input files: %s", curRun, missing)
+        return None
+    # Update volume count
+    params["numVolumes"], _ = read_npts_tr(params["input_feat_file"])
+    logger.debug("numVolumes = %s", params["numVolumes"])
+    # Update TR duration
+    #cresult = run_command(
+    #    "sh getTRDuration.sh " + params["input_feat_file"] + ".nii.gz",
+    #    capture_output=True,
+    #)
+    #params["TR_duration"] = float(cresult.stdout)
+    #logger.debug(f'TR_duration = {params["TR_duration"]}')
+
+    # Create block specific fsf file
+    blockGLMfsf = fill_in_template(GLM2Template, params)
+    blockGLMPath = os.path.join(runDir, "block" + curRun + "_GLM2onlypost_control.fsf")
+    with open(blockGLMPath, "wb") as file:
+        file.write(blockGLMfsf.encode("utf-8"))
+    return blockGLMPath
+
+
+def run_feat(blockGLMPath):
+    """Run fsl's FEAT on a run's fsf file, logging its output next to the fsf file.
+
+    Arguments:
+        blockGLMPath {str} -- Path to the fsf file written by write_run_fsf.
+
+    Returns:
+        subprocess.CompletedProcess -- Result of the feat call.
+
+    """
+    scommand = ["feat", blockGLMPath]
+    featLogPath = os.path.splitext(blockGLMPath)[0] + ".log"
+    return run_command(
+        scommand, cwd=os.path.dirname(blockGLMPath), log_path=featLogPath
+    )
+
+
+def _run_feat_in_worker(blockGLMPath):
+    """Run run_feat in a pool worker, returning (path, status) instead of raising.
+
+    An exception escaping a worker makes the pool terminate the other workers, which
+    leaves their FEAT processes running unattended and the queued runs unstarted.
+    """
+    try:
+        run_feat(blockGLMPath)
+    except Exception:
+        logger.exception("FEAT failed on %s.", blockGLMPath)
+        return blockGLMPath, "failed"
+    return blockGLMPath, "done"
+
+
+def session_GLM(workingDir, inputFolders, jobs=1, submit="local"):
     """Run initial session GLMs using fsl's FEAT.
 
+    The fsf files for all runs are written first, so a template placeholder with no
+    value or a missing input shows up before any FEAT job has started. FEAT is then
+    run on them.
+
     Arguments:
         workingDir {str} -- Path to directory containing template fsf files.
         inputFolders {[str]} -- List of paths to the runs to process.
+
+    Keyword Arguments:
+        jobs {int} -- Number of FEAT runs in parallel when running locally.
+            (default: {1})
+        submit {str} -- "local" to run FEAT here, "slurm" to submit one SLURM array
+            task per fsf file, or "none" to only write the fsf files.
+            (default: {"local"})
+
+    Raises:
+        RuntimeError: Raised before any FEAT run if the template has a placeholder
+            with no value. Raised at the end if any run was skipped for missing
+            inputs or, once every FEAT run has been attempted, if any of them failed.
     """
     logger.addHandler(get_FileHandler(os.path.join(workingDir, "GLM2.log")))
-    with open(os.path.join(workingDir, "GLM2_template_onlypostcue_control.fsf"), "r") as file:
-        GLM2Template = file.read()
-        logger.debug(f"Read GLM2Template from {file.name}.")
+    templatePath = os.path.join(workingDir, "GLM2_template_onlypostcue_control.fsf")
+    GLM2Template = load_template(templatePath)
+    logger.debug("Read GLM2Template from %s.", templatePath)
 
+    written = []
     for runDir in inputFolders:
-        # Grab the ID number of current input
-        curRun = runDir[-2:]
-        logger.info("Starting run {}".format(curRun))
-        # Get details on current block
-        #curRep = blockReps[blockReps["runNum"] == int(curRun)]
-
-        # Set parameters
-        params = {}
-        params["input_feat_file"] = os.path.join(runDir, curRun + "-preprocess.feat","denoised_data.nii.gz")
-        logger.debug(f'input_feat_file = {params["input_feat_file"]}')
-        # Update volume count
-        cresult = run_command(
-            "sh getNumVolume.sh " + params["input_feat_file"],
-            capture_output=True,
+        try:
+            written.append((runDir, write_run_fsf(runDir, workingDir, GLM2Template)))
+        except KeyError as err:
+            # Every run is filled from the same template, so stop before any FEAT run
+            msg = "Cannot fill in {}, no FEAT run started. {}".format(
+                templatePath, err.args[0]
+            )
+            logger.error(msg)
+            raise RuntimeError(msg) from err
+    fsfPaths = [path for _, path in written if path is not None]
+    skipped = [runDir for runDir, path in written if path is None]
+    logger.info("Wrote %d of %d fsf files.", len(fsfPaths), len(inputFolders))
+    failed = []
+    if submit == "slurm":
+        submit_slurm(workingDir, fsfPaths)
+    elif submit == "local":
+        with mp.Pool(processes=jobs) as pool:
+            statuses = list(pool.imap_unordered(_run_feat_in_worker, fsfPaths))
+            pool.close()
+            pool.join()
+        failed = [path for path, status in statuses if status == "failed"]
+    if failed or skipped:
+        msg = "Of {} runs, {} failed FEAT: {}, and {} were skipped: {}".format(
+            len(inputFolders), len(failed), failed, len(skipped), skipped
+        )
+        logger.error(msg)
+        raise RuntimeError(msg)
+
+
+def submit_slurm(workingDir, fsfPaths):
+    """Submit FEAT on the given fsf files as a SLURM array job, one task per file.
+
+    Writes the fsf file list and the job script next to the template fsf files,
+    then calls sbatch.
+
+    Arguments:
+        workingDir {str} -- Path to directory containing template fsf files.
+        fsfPaths {[str]} -- Paths to the fsf files to run FEAT on.
+
+    Returns:
+        subprocess.CompletedProcess -- Result of the sbatch call, or None if there
+            were no fsf files to submit.
+
+    """
+    if not fsfPaths:
+        logger.warning("No runs to submit.")
+        return None
+    jobName = os.path.splitext(os.path.basename(__file__))[0]
+    fsfList = os.path.join(workingDir, jobName + "_fsflist.txt")
+    with open(fsfList, "w") as file:
+        file.writelines(path + "\n" for path in fsfPaths)
+    sbatchPath = os.path.join(workingDir, jobName + "_sbatch.sh")
+    with open(sbatchPath, "w") as file:
+        file.write(
+            SBATCH_TEMPLATE.format(
+                job_name=jobName, log_dir=workingDir, fsf_list=fsfList
+            )
         )
-        params["numVolumes"] = int(cresult.stdout)
-        logger.debug(f'numVolumes = {params["numVolumes"]}')
-        # Update TR duration
-        #cresult = run_command(
-        #    "sh getTRDuration.sh " + params["input_feat_file"] + ".nii.gz",
-        #    capture_output=True,
-        #)
-        #params["TR_duration"] = float(cresult.stdout)
-        #logger.debug(f'TR_duration = {params["TR_duration"]}')
-        # Set EV paths
-        EVPrefix = "EVfiles/GLM2_run" + curRun + "_"
-        params["missing05CorrPath"] = os.path.join(workingDir, EVPrefix + "missing05_onlypostcorr.txt")
-        logger.debug(f'missing05CorrPath = {params["missing05CorrPath"]}')
-        params["missing06CorrPath"] = os.path.join(workingDir, EVPrefix + "missing06_onlypostcorr.txt")
-        logger.debug(f'missing06CorrPath = {params["missing06CorrPath"]}')
-        params["missing07CorrPath"] = os.path.join(workingDir, EVPrefix + "missing07_onlypostcorr.txt")
-        logger.debug(f'missing07CorrPath = {params["missing07CorrPath"]}')
-        params["missing08CorrPath"] = os.path.join(workingDir, EVPrefix + "missing08_onlypostcorr.txt")
-        logger.debug(f'missing08CorrPath = {params["missing08CorrPath"]}')
-        params["missing09CorrPath"] = os.path.join(workingDir, EVPrefix + "missing09_onlypostcorr.txt")
-        logger.debug(f'missing09CorrPath = {params["missing09CorrPath"]}')
-        params["missing15CorrPath"] = os.path.join(workingDir, EVPrefix + "missing15_onlypostcorr.txt")
-        logger.debug(f'missing15CorrPath = {params["missing15CorrPath"]}')
-        params["missing16CorrPath"] = os.path.join(workingDir, EVPrefix + "missing16_onlypostcorr.txt")
-        logger.debug(f'missing16CorrPath = {params["missing16CorrPath"]}')
-        params["missing17CorrPath"] = os.path.join(workingDir, EVPrefix + "missing17_onlypostcorr.txt")
-        logger.debug(f'missing17CorrPath = {params["missing17CorrPath"]}')
-        params["missing18CorrPath"] = os.path.join(workingDir, EVPrefix + "missing18_onlypostcorr.txt")
-        logger.debug(f'missing18CorrPath = {params["missing18CorrPath"]}')
-        params["missing19CorrPath"] = os.path.join(workingDir, EVPrefix + "missing19_onlypostcorr.txt")
-        logger.debug(f'missing19CorrPath = {params["missing19CorrPath"]}')
-        params["missing25CorrPath"] = os.path.join(workingDir, EVPrefix + "missing25_onlypostcorr.txt")
-        logger.debug(f'missing25CorrPath = {params["missing25CorrPath"]}')
-        params["missing26CorrPath"] = os.path.join(workingDir, EVPrefix + "missing26_onlypostcorr.txt")
-        logger.debug(f'missing26CorrPath = {params["missing26CorrPath"]}')
-        params["missing27CorrPath"] = os.path.join(workingDir, EVPrefix + "missing27_onlypostcorr.txt")
-        logger.debug(f'missing27CorrPath = {params["missing27CorrPath"]}')
-        params["missing28CorrPath"] = os.path.join(workingDir, EVPrefix + "missing28_onlypostcorr.txt")
-        logger.debug(f'missing28CorrPath = {params["missing28CorrPath"]}')
-        params["missing29CorrPath"] = os.path.join(workingDir, EVPrefix + "missing29_onlypostcorr.txt")
-        logger.debug(f'missing29CorrPath = {params["missing29CorrPath"]}')
-        params["missing35CorrPath"] = os.path.join(workingDir, EVPrefix + "missing35_onlypostcorr.txt")
-        logger.debug(f'missing35CorrPath = {params["missing35CorrPath"]}')
-        params["missing36CorrPath"] = os.path.join(workingDir, EVPrefix + "missing36_onlypostcorr.txt")
-        logger.debug(f'missing36CorrPath = {params["missing36CorrPath"]}')
-        params["missing37CorrPath"] = os.path.join(workingDir, EVPrefix + "missing37_onlypostcorr.txt")
-        logger.debug(f'missing37CorrPath = {params["missing37CorrPath"]}')
-        params["missing38CorrPath"] = os.path.join(workingDir, EVPrefix + "missing38_onlypostcorr.txt")
-        logger.debug(f'missing38CorrPath = {params["missing38CorrPath"]}')
-        params["missing39CorrPath"] = os.path.join(workingDir, EVPrefix + "missing39_onlypostcorr.txt")
-        logger.debug(f'missing39CorrPath = {params["missing39CorrPath"]}')
-        params["missing45CorrPath"] = os.path.join(workingDir, EVPrefix + "missing45_onlypostcorr.txt")
-        logger.debug(f'missing45CorrPath = {params["missing45CorrPath"]}')
-        params["missing46CorrPath"] = os.path.join(workingDir, EVPrefix + "missing46_onlypostcorr.txt")
-        logger.debug(f'missing46CorrPath = {params["missing46CorrPath"]}')
-        params["missing47CorrPath"] = os.path.join(workingDir, EVPrefix + "missing47_onlypostcorr.txt")
-        logger.debug(f'missing47CorrPath = {params["missing47CorrPath"]}')
-        params["missing48CorrPath"] = os.path.join(workingDir, EVPrefix + "missing48_onlypostcorr.txt")
-        logger.debug(f'missing48CorrPath = {params["missing48CorrPath"]}')
-        params["missing49CorrPath"] = os.path.join(workingDir, EVPrefix + "missing49_onlypostcorr.txt")
-        logger.debug(f'missing49CorrPath = {params["missing49CorrPath"]}')
-        params["testarraypostcuePath"] = os.path.join(workingDir, EVPrefix + "testarraypostcue.txt")
-        logger.debug(f'testarraypostcuePath = {params["testarraypostcuePath"]}')
-        params["testarrayretrocuePath"] = os.path.join(workingDir, EVPrefix + "testarrayretrocue.txt")
-        logger.debug(f'testarrayretrocuePath = {params["testarrayretrocuePath"]}')
-        params["memoryarrayretrocuePath"] = os.path.join(workingDir, EVPrefix + "memoryarrayretrocue.txt")
-        logger.debug(f'memoryarrayretrocuePath = {params["memoryarrayretrocuePath"]}')
-        params["missing05IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing05_onlypostincorr.txt")
-        logger.debug(f'missing05IncorrPath = {params["missing05IncorrPath"]}')
-        params["missing06IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing06_onlypostincorr.txt")
-        logger.debug(f'missing06IncorrPath = {params["missing06IncorrPath"]}')
-        params["missing07IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing07_onlypostincorr.txt")
-        logger.debug(f'missing07IncorrPath = {params["missing07IncorrPath"]}')
-        params["missing08IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing08_onlypostincorr.txt")
-        logger.debug(f'missing08IncorrPath = {params["missing08IncorrPath"]}')
-        params["missing09IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing09_onlypostincorr.txt")
-        logger.debug(f'missing09IncorrPath = {params["missing09IncorrPath"]}')
-        params["missing15IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing15_onlypostincorr.txt")
-        logger.debug(f'missing15IncorrPath = {params["missing15IncorrPath"]}')
-        params["missing16IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing16_onlypostincorr.txt")
-        logger.debug(f'missing16IncorrPath = {params["missing16IncorrPath"]}')
-        params["missing17IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing17_onlypostincorr.txt")
-        logger.debug(f'missing17IncorrPath = {params["missing17IncorrPath"]}')
-        params["missing18IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing18_onlypostincorr.txt")
-        logger.debug(f'missing18IncorrPath = {params["missing18IncorrPath"]}')
-        params["missing19IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing19_onlypostincorr.txt")
-        logger.debug(f'missing19IncorrPath = {params["missing19IncorrPath"]}')
-        params["missing25IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing25_onlypostincorr.txt")
-        logger.debug(f'missing25IncorrPath = {params["missing25IncorrPath"]}')
-        params["missing26IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing26_onlypostincorr.txt")
-        logger.debug(f'missing26IncorrPath = {params["missing26IncorrPath"]}')
-        params["missing27IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing27_onlypostincorr.txt")
-        logger.debug(f'missing27IncorrPath = {params["missing27IncorrPath"]}')
-        params["missing28IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing28_onlypostincorr.txt")
-        logger.debug(f'missing28IncorrPath = {params["missing28IncorrPath"]}')
-        params["missing29IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing29_onlypostincorr.txt")
-        logger.debug(f'missing29IncorrPath = {params["missing29IncorrPath"]}')
-        params["missing35IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing35_onlypostincorr.txt")
-        logger.debug(f'missing35IncorrPath = {params["missing35IncorrPath"]}')
-        params["missing36IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing36_onlypostincorr.txt")
-        logger.debug(f'missing36IncorrPath = {params["missing36IncorrPath"]}')
-        params["missing37IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing37_onlypostincorr.txt")
-        logger.debug(f'missing37IncorrPath = {params["missing37IncorrPath"]}')
-        params["missing38IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing38_onlypostincorr.txt")
-        logger.debug(f'missing38IncorrPath = {params["missing38IncorrPath"]}')
-        params["missing39IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing39_onlypostincorr.txt")
-        logger.debug(f'missing39IncorrPath = {params["missing39IncorrPath"]}')
-        params["missing45IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing45_onlypostincorr.txt")
-        logger.debug(f'missing45IncorrPath = {params["missing45IncorrPath"]}')
-        params["missing46IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing46_onlypostincorr.txt")
-        logger.debug(f'missing46IncorrPath = {params["missing46IncorrPath"]}')
-        params["missing47IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing47_onlypostincorr.txt")
-        logger.debug(f'missing47IncorrPath = {params["missing47IncorrPath"]}')
-        params["missing48IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing48_onlypostincorr.txt")
-        logger.debug(f'missing48IncorrPath = {params["missing48IncorrPath"]}')
-        params["missing49IncorrPath"] = os.path.join(workingDir, EVPrefix + "missing49_onlypostincorr.txt")
-        logger.debug(f'missing49IncorrPath = {params["missing49IncorrPath"]}')
-
-        # Create block specific fsf file
-        blockGLMfsf = fill_in_template(GLM2Template, params)
-        blockGLMPath = os.path.join(runDir, "block" + curRun + "_GLM2onlypost_control.fsf")
-        with open(blockGLMPath, "w") as file:
-            file.write(blockGLMfsf)
-
-        # run FEAT
-        curDir = os.getcwd()
-        os.chdir(runDir)
-        scommand = 'feat "' + blockGLMPath + '"'
-        results = run_command(scommand,capture_output=True)
-        #logger.debug(f"feat CLI run results: {results}")
-        os.chdir(curDir)
+    return run_command(
+        ["sbatch", "--array=0-{}".format(len(fsfPaths) - 1), sbatchPath],
+        cwd=workingDir,
+    )
+
+
+def read_run_ids(toProcess):
+    """Read the run IDs listed in to_process_main.txt.
+
+    Arguments:
+        toProcess {str} -- Path to to_process_main.txt.
+
+    Returns:
+        [str] -- The two digit ID at the start of each line. Blank lines and # comments
+            are skipped; any other line without a run ID is skipped with a warning, so
+            a malformed file does not quietly shrink the batch.
+
+    """
+    runIDs = []
+    with open(toProcess, "r") as inputs:
+        for line in inputs:
+            match = RUN_ID_RE.match(line)
+            if match:
+                runIDs.append(match.group(1))
+            elif line.strip() and not line.lstrip().startswith("#"):
+                logger.warning(
+                    "Ignoring %r in %s, it does not start with a run ID.",
+                    line.strip(),
+                    toProcess,
+                )
+    return runIDs
+
 
 def session_GLM_CLI(args):
     workingDir = os.path.abspath(os.path.expanduser(args.workingDir))
     # Use to_process.txt to define input run folders
     toProcess = os.path.join(workingDir, "to_process_main.txt")
-    inputFolders = []
-    with open(toProcess, "r") as inputs:
-        for inputFilename in inputs:
-            # Grab the ID number of current input
-            cur_nifii = inputFilename[0:2]
-            inputFolders += [os.path.join(workingDir, "run" + cur_nifii)]
-    session_GLM(workingDir, inputFolders)
+    inputFolders = [
+        os.path.join(workingDir, "run" + runID) for runID in read_run_ids(toProcess)
+    ]
+    session_GLM(workingDir, inputFolders, jobs=args.jobs, submit=args.submit)
 
 
 if __name__ == "__main__":
@@ -272,7 +493,28 @@ if __name__ == "__main__":
         default=".",
         help="Working directory containing template fsf files",
     )
+    sessionParser.add_argument(
+        "--jobs",
+        type=int,
+        default=max(1, mp.cpu_count() // 2),
+        help="Number of runs to process in parallel (default: half the CPU count, "
+        "since FEAT does some threading of its own)",
+    )
+    sessionParser.add_argument(
+        "--submit",
+        choices=("local", "slurm", "none"),
+        default="local",
+        help="After writing the fsf files, run FEAT here (local, default), submit one "
+        "SLURM array task per run (slurm), or stop (none)",
+    )
+    sessionParser.add_argument(
+        "--dry-run",
+        dest="submit",
+        action="store_const",
+        const="none",
+        help="Only write the fsf files, same as --submit none",
+    )
 
     args = parser.parse_args()
-    logger.debug(f"Parsed: {args}")
+    logger.debug("Parsed: %s", args)
     args.func(args)
@@ -22,7 +22,7 @@ logger.addHandler(streamhdlr)
 logger.setLevel(logging.DEBUG)
 
 
-def run_command(scommand, capture_output=False):
+def run_command(scommand, capture_output=False, cwd=None):
     """Run a command with the shell.
 
     Arguments:
@@ -31,6 +31,8 @@ def run_command(scommand, capture_output=False):
     Keyword Arguments:
         capture_output {bool} -- Allow the output from the command to be accessed via the
             .stdout attribute on the returned CompletedProcess. (default: {False})
+        cwd {str} -- Directory to run the command in. Passed through to subprocess.run
+            so the process-wide working directory is never changed. (default: {None})
 
     Raises:
         RuntimeError: Raised if the command returns a non-zero return code.
@@ -42,12 +44,13 @@ def run_command(scommand, capture_output=False):
     logger.info("About to run:\n{}".format(scommand))
     sargs = shlex.split(scommand)
     if capture_output:
-        process_results = subprocess.run(sargs, stdout=subprocess.PIPE)
+        process_results = subprocess.run(sargs, stdout=subprocess.PIPE, cwd=cwd)
     else:
-        process_results = subprocess.run(sargs)
+        process_results = subprocess.run(sargs, cwd=cwd)
     if process_results.returncode:
-        logger.error("Received non-zero return code: {}".format(process_results))
-        raise RuntimeError("Received non-zero return code: {}".format(process_results))
+        msg = f"Command {sargs!r} failed with return code {process_results.returncode}"
+        logger.error(msg)
+        raise RuntimeError(msg)
     return process_results
 
 
@@ -101,39 +104,33 @@ def session_GLM(workingDir, inputFoldersLoc, inputFoldersMain):
     
     for runDir in inputFoldersLoc:
         # Grab the ID number of current input
-        curDir = os.getcwd()
-        os.chdir(runDir)
-        os.chdir("GLMloc.feat")
         curRun = runDir[-2:]
         logger.info("Starting run {}".format(curRun))
+        featDir = os.path.join(runDir, "GLMloc.feat")
         # Grab the regressor height from "design.con"
-        designLoc = pd.read_table("design.con",skiprows=range(0,13),header=None)
+        designLoc = pd.read_table(os.path.join(featDir, "design.con"),skiprows=range(0,13),header=None)
         reg_heights_loc = pd.Series.to_numpy(designLoc.loc[0,2:])
         # For each event of interest in this run, convert PE to PSC (percent signal change); 10 for loc
         for cope in range(1,11):
-            cresult = run_command('fslmaths stats/cope' + str(cope) + ' -mul ' + str(reg_heights_loc[cope-1] * 100) + ' -div mean_func stats/cope' + str(cope) + '_PSC')
-        os.chdir(curDir)
+            cresult = run_command('fslmaths stats/cope' + str(cope) + ' -mul ' + str(reg_heights_loc[cope-1] * 100) + ' -div mean_func stats/cope' + str(cope) + '_PSC', cwd=featDir)
 
     for runDir in inputFoldersMain:
-        logger.info("Starting run {}".format(curRun))
-        os.chdir(runDir)
-        os.chdir("GLM1.feat")
         curRun = runDir[-2:]
+        logger.info("Starting run {}".format(curRun))
+        featDir = os.path.join(runDir, "GLM1.feat")
         # Grab the regressor height from "design.con"
-        designGLM1 = pd.read_table("design.con",skiprows=range(0,26),header=None)
+        designGLM1 = pd.read_table(os.path.join(featDir, "design.con"),skiprows=range(0,26),header=None)
         reg_heights_glm1 = pd.Series.to_numpy(designGLM1.loc[0,2:])
         # For each event of interest in this run, convert PE to PSC (percent signal change); 20 for GLM1
         for cope in range(1,21):
-            cresult = run_command('fslmaths stats/cope' + str(cope) + ' -mul ' + str(reg_heights_glm1[cope-1] * 100) + ' -div mean_func stats/cope' + str(cope) + '_PSC')
-        os.chdir("..")
-        os.chdir("GLM2.feat")
+            cresult = run_command('fslmaths stats/cope' + str(cope) + ' -mul ' + str(reg_heights_glm1[cope-1] * 100) + ' -div mean_func stats/cope' + str(cope) + '_PSC', cwd=featDir)
+        featDir = os.path.join(runDir, "GLM2.feat")
         # Grab the regressor height from "design.con"
-        designGLM2 = pd.read_table("design.con",skiprows=range(0,30),header=None)
+        designGLM2 = pd.read_table(os.path.join(featDir, "design.con"),skiprows=range(0,30),header=None)
         reg_heights_glm2 = pd.Series.to_numpy(designGLM2.loc[0,2:])
         # For each event of interest in this run, convert PE to PSC (percent signal change); 25 for GLM1
         for cope in range(1,26):
-            cresult = run_command('fslmaths stats/cope' + str(cope) + ' -mul ' + str(reg_heights_glm2[cope-1] * 100) + ' -div mean_func stats/cope' + str(cope) + '_PSC')
-        os.chdir(curDir)
+            cresult = run_command('fslmaths stats/cope' + str(cope) + ' -mul ' + str(reg_heights_glm2[cope-1] * 100) + ' -div mean_func stats/cope' + str(cope) + '_PSC', cwd=featDir)
 
 def session_GLM_CLI(args):
     workingDir = os.path.abspath(os.path.expanduser(args.workingDir))
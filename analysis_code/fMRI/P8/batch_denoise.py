@@ -28,7 +28,7 @@ logger.addHandler(streamhdlr)
 logger.setLevel(logging.DEBUG)
 
 
-def run_command(scommand, capture_output=False):
+def run_command(scommand, capture_output=False, cwd=None):
     """Run a command with the shell.
 
     Arguments:
@@ -37,6 +37,8 @@ def run_command(scommand, capture_output=False):
     Keyword Arguments:
         capture_output {bool} -- Allow the output from the command to be accessed via the
             .stdout attribute on the returned CompletedProcess. (default: {False})
+        cwd {str} -- Directory to run the command in. Passed through to subprocess.run
+            so the process-wide working directory is never changed. (default: {None})
 
     Raises:
         RuntimeError: Raised if the command returns a non-zero return code.
@@ -48,12 +50,13 @@ def run_command(scommand, capture_output=False):
     logger.info("About to run:\n{}".format(scommand))
     sargs = shlex.split(scommand)
     if capture_output:
-        process_results = subprocess.run(sargs, stdout=subprocess.PIPE)
+        process_results = subprocess.run(sargs, stdout=subprocess.PIPE, cwd=cwd)
     else:
-        process_results = subprocess.run(sargs)
+        process_results = subprocess.run(sargs, cwd=cwd)
     if process_results.returncode:
-        logger.error("Received non-zero return code: {}".format(process_results))
-        raise RuntimeError("Received non-zero return code: {}".format(process_results))
+        msg = f"Command {sargs!r} failed with return code {process_results.returncode}"
+        logger.error(msg)
+        raise RuntimeError(msg)
     return process_results
 
 
@@ -103,13 +106,12 @@ def session_GLM(workingDir, inputFolders):
         workingDir {str} -- Path to directory containing template fsf files.
         inputFolders {[str]} -- List of paths to the runs to process.
     """
-    curDir = os.getcwd()
     for runDir in inputFolders:
         # Grab the ID number of current input
         curRun = runDir[-2:]
         logger.info("Starting run {}".format(curRun))
-        os.chdir(os.path.join(runDir, curRun + "-preprocess.feat"))
-        with open(os.path.join(runDir, curRun + "-preprocess.feat","filtered_func_data.ica","reject_ica.txt"), "r") as file:
+        featDir = os.path.join(runDir, curRun + "-preprocess.feat")
+        with open(os.path.join(featDir, "filtered_func_data.ica", "reject_ica.txt"), "r") as file:
                 reject_components = file.readlines()
         reject_which = reject_components[-1][1:-2]
         
@@ -117,8 +119,8 @@ def session_GLM(workingDir, inputFolders):
         cresult = run_command(
             "fsl_regfilt -i filtered_func_data -o denoised_data -d filtered_func_data.ica/melodic_mix -f '" + reject_which + "'",
             capture_output=True,
+            cwd=featDir,
         )
-        os.chdir(curDir)
 
 def session_GLM_CLI(args):
     workingDir = os.path.abspath(os.path.expanduser(args.workingDir))